@@ -45,7 +45,6 @@ import (
 import (
   "github.com/timtadh/getopt"
   "github.com/timtadh/netutils"
-  "github.com/timtadh/queued/net"
   "github.com/timtadh/data-structures/types"
 )
 
@@ -236,18 +235,66 @@ func ErrorHandler() (chan<- error) {
     return errors
 }
 
-func CmdParse(line []byte) (cmd string, rest []byte, err error) {
-    defer func() {
-        if e := recover(); e != nil {
-            if E, ok := e.(error); ok {
-                err = E
-            } else {
-                err = fmt.Errorf("%v", e)
+// EncodeMessage frames a message as a "<cmd> <len>\n" header followed by
+// exactly len raw body bytes. This replaces the old base64 line encoding so
+// large bodies cross the pipe without an O(n) re-encode on either side.
+func EncodeMessage(cmd string, body []byte) []byte {
+    msg := make([]byte, 0, len(cmd)+len(body)+16)
+    msg = append(msg, []byte(cmd)...)
+    msg = append(msg, ' ')
+    msg = append(msg, []byte(strconv.Itoa(len(body)))...)
+    msg = append(msg, '\n')
+    msg = append(msg, body...)
+    return msg
+}
+
+type Frame struct {
+    Cmd string
+    Rest []byte
+}
+
+func readLine(reader <-chan byte) (line []byte, ok bool) {
+    for b := range reader {
+        if b == '\n' {
+            return line, true
+        }
+        line = append(line, b)
+    }
+    return line, false
+}
+
+func Frames(reader <-chan byte, errors chan<- error) (<-chan Frame) {
+    frames := make(chan Frame)
+    go func() {
+        defer close(frames)
+        for {
+            header, ok := readLine(reader)
+            if !ok {
+                return
+            }
+            split := strings.SplitN(strings.TrimSpace(string(header)), " ", 2)
+            cmd := split[0]
+            length := 0
+            if len(split) > 1 {
+                var err error
+                length, err = strconv.Atoi(split[1])
+                if err != nil {
+                    errors<-err
+                    return
+                }
             }
+            body := make([]byte, 0, length)
+            for len(body) < length {
+                b, ok := <-reader
+                if !ok {
+                    return
+                }
+                body = append(body, b)
+            }
+            frames<-Frame{cmd, body}
         }
     }()
-    cmd, rest = net.DecodeMessage(line)
-    return cmd, rest, nil
+    return frames
 }
 
 type State interface {
@@ -276,17 +323,19 @@ func (self *BaseState) CloseConnection() bool {
 
 func (self *BaseState) HandleError(err error) {
     self.Errors<-err
-    self.Writer<-net.EncodeMessage("ERROR", []byte(err.Error()))
+    self.Writer<-EncodeMessage("ERROR", []byte(err.Error()))
 }
 
 func (self *StartState) Command(cmd string, rest []byte) State {
     switch cmd {
+    case "RESET":
+        self.Writer<-EncodeMessage("OK", nil)
     case "LOAD":
         G, err := Load(string(rest))
         if err != nil {
             self.HandleError(err)
         } else {
-            self.Writer<-net.EncodeMessage("OK", nil)
+            self.Writer<-EncodeMessage("OK", nil)
             return &LoadedState{self.BaseState, G}
         }
     default:
@@ -469,8 +518,11 @@ func SerializeGraphs(graphs []*graph.Graph) ([]byte, error) {
 
 func (self *LoadedState) Command(cmd string, rest []byte) State {
     switch cmd {
+    case "RESET":
+        self.Writer<-EncodeMessage("OK", nil)
+        return &StartState{self.BaseState}
     case "CANDIDATES":
-        self.Writer<-net.EncodeMessage(
+        self.Writer<-EncodeMessage(
             "CANDIDATES",
             []byte(
                 GetCandidates(self.G, string(rest), 1).String(),
@@ -486,7 +538,7 @@ func (self *LoadedState) Command(cmd string, rest []byte) State {
             if err != nil {
                 self.HandleError(err)
             } else {
-                self.Writer<-net.EncodeMessage("GRAPHS", s)
+                self.Writer<-EncodeMessage("GRAPHS", s)
             }
         }
     case "NODE":
@@ -503,7 +555,7 @@ func (self *LoadedState) Command(cmd string, rest []byte) State {
                 if err != nil {
                     self.HandleError(err)
                 } else {
-                    self.Writer<-net.EncodeMessage("NODE", bytes)
+                    self.Writer<-EncodeMessage("NODE", bytes)
                 }
             }
         }
@@ -518,7 +570,7 @@ func (self *LoadedState) Command(cmd string, rest []byte) State {
                     if err != nil {
                         self.HandleError(err)
                     } else {
-                        self.Writer<-net.EncodeMessage("EDGE", bytes)
+                        self.Writer<-EncodeMessage("EDGE", bytes)
                     }
                 }
             } else {
@@ -534,7 +586,7 @@ func (self *LoadedState) Command(cmd string, rest []byte) State {
             if err != nil {
                 self.HandleError(err)
             } else {
-                self.Writer<-net.EncodeMessage("GRAPH", g)
+                self.Writer<-EncodeMessage("GRAPH", g)
             }
         }
     case "PARTITION":
@@ -550,7 +602,7 @@ func (self *LoadedState) Command(cmd string, rest []byte) State {
                 if err != nil {
                     self.HandleError(err)
                 } else {
-                    self.Writer<-net.EncodeMessage("GRAPHS", s)
+                    self.Writer<-EncodeMessage("GRAPHS", s)
                 }
             }
         }
@@ -574,7 +626,7 @@ func (self *LoadedState) Command(cmd string, rest []byte) State {
                 if err != nil {
                     self.HandleError(err)
                 } else {
-                    self.Writer<-net.EncodeMessage("GRAPHS", s)
+                    self.Writer<-EncodeMessage("GRAPHS", s)
                 }
             }
         }
@@ -586,14 +638,8 @@ func (self *LoadedState) Command(cmd string, rest []byte) State {
 
 func Connection(reader <-chan byte, writer chan<- []byte, errors chan<- error) {
     var state State = &StartState{BaseState{writer, errors}}
-    lines := netutils.Readlines(reader)
-    for line := range lines {
-        cmd, rest, err := CmdParse(line)
-        if err != nil {
-            state.HandleError(err)
-        } else {
-            state = state.Command(cmd, rest)
-        }
+    for frame := range Frames(reader, errors) {
+        state = state.Command(frame.Cmd, frame.Rest)
         if state.CloseConnection() {
             break
         }
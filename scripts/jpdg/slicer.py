@@ -29,24 +29,137 @@
 # or retrieve version 2.1 at their website:
 #   http://www.gnu.org/licenses/lgpl-2.1.html
 
-import sys, os, threading, time, subprocess, fcntl, json
-from collections import deque
+from __future__ import print_function
+
+import sys, os, re, errno, threading, time, subprocess, fcntl, select, socket
+try:
+    from ujson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+if sys.version_info[0] >= 3:
+    def native(raw):
+        return raw.decode('utf-8')
+    read_input = input
+else:
+    def native(raw):
+        return bytes(raw)
+    read_input = raw_input
+
+def frame(cmd, data):
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return ('%s %d\n' % (cmd, len(data))).encode('utf-8') + data
+
+CANDIDATE = re.compile(r'^(\d+), ([^\n]+)', re.MULTILINE)
+
+class SlicerError(Exception): pass
+
+EDGE_FILTERS = dict()
+
+class NullLock(object):
+
+    def acquire(self):
+        pass
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+class FrameParser(object):
+    '''Incremental parser for "<cmd> <len>\n<body>" frames. feed() takes the
+    bytes from one read and returns the complete (cmd, body) frames they
+    finish; partial frames stay buffered. The newline scan is memchr via
+    bytearray.find, so feed costs O(bytes) with no interpreter work per
+    byte.'''
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.cmd = None
+        self.length = 0
+
+    def feed(self, data):
+        buf = self.buf
+        buf += data
+        frames = list()
+        while True:
+            if self.cmd is None:
+                idx = buf.find(b'\n')
+                if idx < 0:
+                    return frames
+                split = native(buf[:idx]).split(' ', 1)
+                del buf[:idx+1]
+                self.cmd = split[0]
+                self.length = int(split[1]) if len(split) > 1 else 0
+            if len(buf) < self.length:
+                return frames
+            frames.append((self.cmd, native(buf[:self.length])))
+            del buf[:self.length]
+            self.cmd = None
+
+def edge_filter_args(filtered_edges):
+    key = tuple(filtered_edges)
+    try:
+        return EDGE_FILTERS[key]
+    except KeyError:
+        args = ' '.join('-e ' + e for e in key)
+        EDGE_FILTERS[key] = args
+        return args
+
+def slice_args(prefix, direction, filtered_edges):
+    args = '-p ' + prefix
+    if direction is not None:
+        args += ' -d ' + direction
+    if filtered_edges:
+        args += ' ' + edge_filter_args(filtered_edges)
+    return args
+
+def sub_graph_args(nodes, filtered_edges):
+    args = ''
+    if filtered_edges:
+        args = edge_filter_args(filtered_edges) + ' '
+    return args + ' '.join(map(str, nodes))
 
 class Slicer(object):
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, single_threaded=False):
         self.debug = debug
+        self.sock, child = socket.socketpair()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
         self.p = subprocess.Popen(['slicebot'],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
+            stdin=child.fileno(),
+            stdout=child.fileno(),
+            bufsize=0,
         )
-        self.slicer_lock = threading.Lock()
-        self.lines = deque()
-        self.lines_cv = threading.Condition()
-        self.closed = False
-        self.read_thread = threading.Thread(target=self.listen)
-        self.read_thread.daemon = True
-        self.read_thread.start()
+        child.close()
+        self.stdin_fd = self.sock.fileno()
+        self.stdout_fd = self.sock.fileno()
+        flags = fcntl.fcntl(self.stdout_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.stdout_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.poller.register(self.stdout_fd, select.EPOLLIN)
+        elif hasattr(select, 'poll'):
+            self.poller = select.poll()
+            self.poller.register(self.stdout_fd, select.POLLIN)
+        else:
+            self.poller = None
+        if single_threaded:
+            self.slicer_lock = NullLock()
+        else:
+            self.slicer_lock = threading.Lock()
+        self.pending = list()
+        self.pending_at = 0
+        self.node_cache = dict()
+        self.edge_cache = dict()
+        self.parser = FrameParser()
+        self.closed = threading.Event()
 
     def __enter__(self):
         return self
@@ -55,189 +168,402 @@ class Slicer(object):
         self.close()
 
     def close(self):
-        self._close(False)
-
-    def _close(self, from_read=False):
-        if self.debug and from_read:
-            print >>sys.stderr, "read thread closing it"
-        with self.slicer_lock:
-            with self.lines_cv:
-                if self.closed:
-                    if self.debug and from_read:
-                        print >>sys.stderr, "read thread bailed"
-                    return
-                self.closed = True
-                self.lines_cv.notifyAll()
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        if hasattr(self.poller, 'close'):
+            self.poller.close()
         self.p.kill()
-        if not from_read:
-            self.read_thread.join()
         self.p.wait()
+        self.sock.close()
         if self.debug:
-            print >>sys.stderr, "closed"
-            if from_read:
-                print >>sys.stderr, "read thread closed it"
+            print("closed", file=sys.stderr)
 
     def load(self, path):
+        self.node_cache.clear()
+        self.edge_cache.clear()
         return self.command('LOAD', path, self.generic_response)
 
-    def generic_response(self):
+    def reset(self):
+        self.node_cache.clear()
+        self.edge_cache.clear()
+        return self.command('RESET', '', self.generic_response)
+
+    def _respond(self, expected, parse=None):
         cmd, data = self.get_line()
         if cmd == "ERROR":
-            raise Exception(data)
-        elif cmd != "OK":
-            raise Exception, "bad command recieved %s %s" % (cmd, data)
+            raise SlicerError(data)
+        elif cmd != expected:
+            raise SlicerError("bad command recieved %s %s" % (cmd, data))
+        elif parse is None:
+            return data
         else:
-            return True
+            return parse(data)
+
+    def generic_response(self):
+        return self._respond("OK", lambda data: True)
 
     def candidates(self, prefix):
         return self.command('CANDIDATES', prefix, self.candidates_response)
 
     def candidates_response(self):
-        cmd, data = self.get_line()
-        if cmd == "ERROR":
-            raise Exception(data)
-        elif cmd != "CANDIDATES":
-            raise Exception, "bad command recieved %s %s" % (cmd, data)
-        else:
-            lines = [
-                line.split(', ', 1)
-                for line in data.strip().split('\n')
-                if line and ', ' in line
-            ]
-            return [
-                {'label': row[1], 'count': int(row[0])}
-                for row in lines
-            ]
+        return self._respond("CANDIDATES", lambda data: [
+            {'label': m.group(2), 'count': int(m.group(1))}
+            for m in CANDIDATE.finditer(data)
+        ])
 
     def slice(self, prefix, direction=None, filtered_edges=None):
-        args = ['-p', prefix]
-        if direction is not None:
-            args.append('-d')
-            args.append(direction)
-        if filtered_edges is not None:
-            for e in filtered_edges:
-                args.append('-e')
-                args.append(e)
-        return self.command('SLICE', ' '.join(args), self.slice_response)
+        return self.command('SLICE',
+            slice_args(prefix, direction, filtered_edges), self.slice_response)
+
+    def slice_iter(self, prefix, direction=None, filtered_edges=None):
+        return self.command_iter('SLICE',
+            slice_args(prefix, direction, filtered_edges), "GRAPHS")
 
     def slice_response(self):
-        cmd, data = self.get_line()
-        if cmd == "ERROR":
-            raise Exception(data)
-        elif cmd != "GRAPHS":
-            raise Exception, "bad command recieved %s %s" % (cmd, data)
-        else:
-            return data
+        return self._respond("GRAPHS")
 
     def node(self, nid):
-        args = [str(nid)]
-        return self.command('NODE', ' '.join(args), self.node_response)
+        try:
+            return self.node_cache[nid]
+        except KeyError:
+            result = self.command('NODE', str(nid), self.node_response)
+            self.node_cache[nid] = result
+            return result
 
     def node_response(self):
-        cmd, data = self.get_line()
-        if cmd == "ERROR":
-            raise Exception(data)
-        elif cmd != "NODE":
-            raise Exception, "bad command recieved %s %s" % (cmd, data)
-        else:
-            return json.loads(data)
+        return self._respond("NODE", json_loads)
 
     def edge(self, u, v):
-        args = [str(u), str(v)]
-        return self.command('EDGE', ' '.join(args), self.edge_response)
+        try:
+            return self.edge_cache[(u, v)]
+        except KeyError:
+            result = self.command('EDGE', '%s %s' % (u, v), self.edge_response)
+            self.edge_cache[(u, v)] = result
+            return result
 
     def edge_response(self):
-        cmd, data = self.get_line()
-        if cmd == "ERROR":
-            raise Exception(data)
-        elif cmd != "EDGE":
-            raise Exception, "bad command recieved %s %s" % (cmd, data)
-        else:
-            return json.loads(data)
+        return self._respond("EDGE", json_loads)
 
     def sub_graph(self, nodes, filtered_edges=None):
-        args = list()
-        if filtered_edges is not None:
-            for e in filtered_edges:
-                args.append('-e')
-                args.append(e)
-        args += [str(nid) for nid in nodes]
-        return self.command('SUBGRAPH', ' '.join(args), self.subgraph_response)
+        return self.command('SUBGRAPH',
+            sub_graph_args(nodes, filtered_edges), self.subgraph_response)
+
+    def sub_graph_iter(self, nodes, filtered_edges=None):
+        return self.command_iter('SUBGRAPH',
+            sub_graph_args(nodes, filtered_edges), "GRAPH")
 
     def subgraph_response(self):
-        cmd, data = self.get_line()
-        if cmd == "ERROR":
-            raise Exception(data)
-        elif cmd != "GRAPH":
-            raise Exception, "bad command recieved %s %s" % (cmd, data)
-        else:
-            return data
+        return self._respond("GRAPH")
 
     def partition(self, attr, filtered_edges=None):
-        args = list()
-        if filtered_edges is not None:
-            for e in filtered_edges:
-                args.append('-e')
-                args.append(e)
-        args += ['-a', attr]
-        return self.command('PARTITION', ' '.join(args), self.slice_response)
+        args = ''
+        if filtered_edges:
+            args = edge_filter_args(filtered_edges) + ' '
+        args += '-a ' + attr
+        return self.command('PARTITION', args, self.slice_response)
 
     def projected_partition(self, prefix, attr, filtered_edges=None):
-        args = list()
-        if filtered_edges is not None:
-            for e in filtered_edges:
-                args.append('-e')
-                args.append(e)
-        args += ['-a', attr, '-p', prefix]
-        return self.command('PROJECTED-PARTITION', ' '.join(args), self.slice_response)
+        args = ''
+        if filtered_edges:
+            args = edge_filter_args(filtered_edges) + ' '
+        args += '-a ' + attr + ' -p ' + prefix
+        return self.command('PROJECTED-PARTITION', args, self.slice_response)
 
     def command(self, cmd, data, response):
         with self.slicer_lock:
-            msg = cmd + " " + data.encode('base64').replace('\n', '') + '\n'
-            self.p.stdin.write(msg)
+            self.send(cmd, data)
             return response()
 
-    def listen(self):
-        chunk = ''
+    def command_iter(self, cmd, data, expected):
+        '''Like command, but returns an iterator over the lines of the
+        response body as they arrive, so a huge GRAPHS payload never has
+        to be materialized. The slicer is locked until the iterator is
+        exhausted or closed; abandoning it, even before the first line,
+        drains the rest of the body to keep the protocol in sync.'''
+        self.slicer_lock.acquire()
+        try:
+            self.send(cmd, data)
+            rcmd, length, body = self._next_response()
+            if rcmd != expected:
+                if body is None:
+                    chunks = list()
+                    remaining = length
+                    while remaining > 0:
+                        chunk = self._read_stream(remaining)
+                        remaining -= len(chunk)
+                        chunks.append(chunk)
+                    self._end_stream()
+                    body = native(b''.join(chunks))
+                if rcmd == "ERROR":
+                    raise SlicerError(body)
+                raise SlicerError("bad command recieved %s %s" % (rcmd, body))
+        except:
+            self.slicer_lock.release()
+            raise
+        return ResponseIter(self, length, body)
+
+    def _next_response(self):
+        # Wait for the next response. Returns (cmd, body_length, body) where
+        # body is None if only the header has arrived and the body should be
+        # streamed out of the parser buffer and the socket.
         while True:
-            while "\n" not in chunk:
-                try:
-                    data = os.read(self.p.stdout.fileno(), 4096*64)
-                    if not data:
-                        self._close(True)
-                        return
-                    chunk += data
-                except Exception, e:
-                    print >>sys.stderr, e, type(e)
-                    self._close(True)
-                    return
-            line, chunk = chunk.split('\n', 1)
-            with self.lines_cv:
-                self.lines.append(line)
-                self.lines_cv.notify()
+            if self.pending_at < len(self.pending):
+                rcmd, data = self.get_line()
+                return rcmd, len(data), data
+            if self.parser.cmd is not None:
+                return self.parser.cmd, self.parser.length, None
+            self.pump()
+
+    def _read_stream(self, remaining):
+        # Take up to remaining bytes of the in-flight body, from the parser
+        # buffer if it holds any, otherwise straight off the socket. Bytes
+        # past the body boundary are left buffered for the parser.
+        parser = self.parser
+        if parser.buf:
+            chunk = bytes(parser.buf[:remaining])
+            del parser.buf[:len(chunk)]
+            return chunk
+        if self.closed.is_set():
+            raise SlicerError("queued connection closed")
+        self.wait_readable()
+        try:
+            data = os.read(self.stdout_fd, 4096*64)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return b''
+            print(e, type(e), file=sys.stderr)
+            self.close()
+            raise SlicerError("queued connection closed")
+        if not data:
+            self.close()
+            raise SlicerError("queued connection closed")
+        if len(data) > remaining:
+            parser.buf += data[remaining:]
+            data = data[:remaining]
+        return data
+
+    def _end_stream(self):
+        # The streamed frame was consumed outside the parser; clear its
+        # header and let the parser resume on whatever bytes follow.
+        self.parser.cmd = None
+        self.pending.extend(self.parser.feed(b''))
+
+    def send(self, cmd, data):
+        self.write(frame(cmd, data))
+
+    def write(self, msg):
+        view = memoryview(msg)
+        pos = 0
+        while pos < len(msg):
+            try:
+                pos += os.write(self.stdin_fd, view[pos:])
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EINTR):
+                    raise
+                # the socket is full because slicebot is blocked writing
+                # replies; pump them into pending while waiting for space,
+                # or a large enough batch deadlocks both sides
+                readable, _, _ = select.select(
+                    [self.stdout_fd], [self.stdin_fd], [])
+                if readable:
+                    self.pump()
+
+    def pipeline(self):
+        return Pipeline(self)
+
+    def wait_readable(self):
+        if self.poller is not None:
+            self.poller.poll()
+        else:
+            select.select([self.stdout_fd], [], [])
+
+    def pump(self):
+        if self.closed.is_set():
+            raise SlicerError("queued connection closed")
+        self.wait_readable()
+        try:
+            data = os.read(self.stdout_fd, 4096*64)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            print(e, type(e), file=sys.stderr)
+            self.close()
+            raise SlicerError("queued connection closed")
+        if not data:
+            self.close()
+            raise SlicerError("queued connection closed")
+        self.pending.extend(self.parser.feed(data))
 
     def get_line(self):
-        with self.lines_cv:
-            while len(self.lines) <= 0:
-                if self.closed:
-                    raise Exception, "queued connection closed"
-                self.lines_cv.wait()
-            line = self.lines.popleft()
-        return self.process_line(line)
-
-    def process_line(self, line):
-        split = line.split(' ', 1)
-        command = split[0]
-        rest = None
-        if len(split) > 1:
-            rest = split[1].decode('base64')
+        if self.pending_at >= len(self.pending):
+            del self.pending[:]
+            self.pending_at = 0
+            while not self.pending:
+                self.pump()
+        line = self.pending[self.pending_at]
+        self.pending_at += 1
+        return line
+
+class Pipeline(object):
+    '''Queues commands and submits them as one write, then reads the
+    responses back in submission order. slicebot handles its stdin
+    sequentially, so a batch of lookups pays one pipe round-trip
+    instead of one per command.'''
 
-        return command, rest
+    def __init__(self, slicer):
+        self.slicer = slicer
+        self.calls = list()
+        self.results = list()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def command(self, cmd, data, response):
+        self.calls.append((cmd, data, response))
+
+    def node(self, nid):
+        self.command('NODE', str(nid), self.slicer.node_response)
+
+    def edge(self, u, v):
+        self.command('EDGE', '%s %s' % (u, v), self.slicer.edge_response)
+
+    def flush(self):
+        calls = self.calls
+        self.calls = list()
+        if not calls:
+            return self.results
+        with self.slicer.slicer_lock:
+            self.slicer.write(b''.join(
+                frame(cmd, data)
+                for cmd, data, response in calls
+            ))
+            # every queued response must be consumed, raising or not, or the
+            # replies left behind would be served to later commands
+            error = None
+            for cmd, data, response in calls:
+                try:
+                    result = response()
+                except Exception as e:
+                    if error is None:
+                        error = e
+                    result = e
+                self.results.append(result)
+        if error is not None:
+            raise error
+        return self.results
+
+class ResponseIter(object):
+    '''Iterates the lines of one streamed response body. The slicer stays
+    locked until the iterator is exhausted or closed; close() (which the
+    GC also runs) drains any unread body and releases the lock, whether
+    or not iteration ever started, so abandoning the iterator never
+    wedges the session.'''
+
+    def __init__(self, slicer, length, body):
+        self.slicer = slicer
+        self.streaming = body is None
+        self.remaining = length if body is None else 0
+        self.lines = body.splitlines(True) if body is not None else list()
+        self.at = 0
+        self.tail = b''
+        self.done = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while True:
+            if self.at < len(self.lines):
+                line = self.lines[self.at]
+                self.at += 1
+                return line
+            if self.done:
+                raise StopIteration
+            if self.remaining <= 0:
+                self.close()
+                raise StopIteration
+            chunk = self.slicer._read_stream(self.remaining)
+            self.remaining -= len(chunk)
+            pieces = (self.tail + chunk).splitlines(True)
+            self.tail = b''
+            if self.remaining > 0 and pieces and not pieces[-1].endswith(b'\n'):
+                self.tail = pieces.pop()
+            self.lines = [native(piece) for piece in pieces]
+            self.at = 0
+
+    __next__ = next
+
+    def close(self):
+        if self.done:
+            return
+        self.done = True
+        try:
+            try:
+                while self.remaining > 0:
+                    self.remaining -= len(self.slicer._read_stream(self.remaining))
+                if self.streaming:
+                    self.slicer._end_stream()
+            except SlicerError:
+                # connection already dead; nothing left to resync
+                pass
+        finally:
+            self.slicer.slicer_lock.release()
+
+    def __del__(self):
+        self.close()
+
+class SlicerPool(object):
+    '''Keeps warm slicebot subprocesses and rebinds them between sessions
+    with RESET, so a job that slices many programs pays the spawn cost
+    once per worker instead of once per program.'''
+
+    _default = None
+
+    @classmethod
+    def default(cls):
+        if cls._default is None:
+            cls._default = cls()
+        return cls._default
+
+    def __init__(self, **slicer_kwargs):
+        self.slicer_kwargs = slicer_kwargs
+        self.pool_lock = threading.Lock()
+        self.free = list()
+
+    def acquire(self):
+        with self.pool_lock:
+            while self.free:
+                slicer = self.free.pop()
+                if not slicer.closed.is_set():
+                    return slicer
+        return Slicer(**self.slicer_kwargs)
+
+    def release(self, slicer):
+        if slicer.closed.is_set():
+            return
+        try:
+            slicer.reset()
+        except Exception:
+            slicer.close()
+            return
+        with self.pool_lock:
+            self.free.append(slicer)
+
+    def close(self):
+        with self.pool_lock:
+            free, self.free = self.free, list()
+        for slicer in free:
+            slicer.close()
 
 def _loop(slicer):
     while True:
         try:
-            line = raw_input('> ')
+            line = read_input('> ')
         except:
             break
         split = line.split(' ', 1)
@@ -247,21 +573,21 @@ def _loop(slicer):
             if len(split) > 1:
                 data = split[1]
             if command == 'load' and data is not None:
-                print slicer.load(data)
+                print(slicer.load(data))
             elif command == 'candidates' and data is not None:
                 for c in slicer.candidates(data):
-                    print c
+                    print(c)
             elif command == 'slice' and data is not None:
-                print slicer.slice(data, filtered_edges=['ddg', 'cdg'])
+                print(slicer.slice(data, filtered_edges=['ddg', 'cdg']))
             else:
-                print slicer.command(command.upper(), data if data is not None else
-                        '', slicer.generic_response)
-        except Exception, e:
-            print >>sys.stderr, type(e), e
-        print
+                print(slicer.command(command.upper(), data if data is not None else
+                        '', slicer.generic_response))
+        except Exception as e:
+            print(type(e), e, file=sys.stderr)
+        print()
 
 def main():
-    slicer = Slicer()
+    slicer = Slicer(single_threaded=True)
     try:
        _loop(slicer)
     finally: